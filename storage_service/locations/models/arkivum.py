@@ -1,25 +1,34 @@
 from __future__ import absolute_import
 
 # stdlib, alphabetical
+from concurrent.futures import ThreadPoolExecutor
+import datetime
 import json
 import logging
 from lxml import etree
 import os
+import posixpath
+import random
 import requests
-import six.moves.urllib.request
-import six.moves.urllib.parse
-import six.moves.urllib.error
+from requests.adapters import HTTPAdapter
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from urllib.parse import quote_plus
 
 # Core Django, alphabetical
 from django.conf import settings
+from django.core.cache import cache
 import django.core.mail
 from django.contrib.auth import get_user_model
-from django.db import models
+from django.db import connection, models
 from django.utils.translation import ugettext_lazy as _
 
 # Third party dependencies, alphabetical
 import dateutil.parser
-import scandir
+from urllib3.util.retry import Retry
 
 # This project, alphabetical
 from common import utils
@@ -33,6 +42,174 @@ LOGGER = logging.getLogger(__name__)
 
 VERIFY = not settings.INSECURE_SKIP_VERIFY
 
+# Shared session so that consecutive calls to the same Arkivum host reuse
+# pooled connections instead of paying for a new TCP/TLS handshake each time.
+# Only idempotent methods are retried; POSTs are never replayed. Retry-After
+# is left to _poll_status: urllib3 would otherwise sleep for however long the
+# header asks before each retry, outside of any request timeout. Read timeouts
+# are not retried either, so they surface as requests' Timeout after a single
+# ARKIVUM_READ_TIMEOUT instead of a ConnectionError after several.
+_SESSION = requests.Session()
+_SESSION.verify = VERIFY
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=16,
+        pool_maxsize=max(32, settings.ARKIVUM_POLL_WORKERS * 2),
+        max_retries=Retry(
+            total=3,
+            read=False,
+            backoff_factor=0.3,
+            status_forcelist=[502, 503, 504],
+            raise_on_status=False,
+            respect_retry_after_header=False,
+        ),
+    ),
+)
+
+# (connect, read) timeouts in seconds for every request made to Arkivum
+_TIMEOUT = (settings.ARKIVUM_CONNECT_TIMEOUT, settings.ARKIVUM_READ_TIMEOUT)
+
+# Compiled once, used to read fixity information from pointer files
+_FIXITY_XPATH = etree.XPath("(.//premis:fixity)[1]", namespaces=utils.NSMAP)
+_ALGORITHM_XPATH = etree.XPath(
+    "premis:messageDigestAlgorithm/text()", namespaces=utils.NSMAP
+)
+_CHECKSUM_XPATH = etree.XPath("premis:messageDigest/text()", namespaces=utils.NSMAP)
+_SIZE_XPATH = etree.XPath("premis:size/text()", namespaces=utils.NSMAP)
+
+# Request parts for release POSTs that are the same for every package. The
+# ingest-manifest endpoint expects a multipart body, so an empty file part is
+# sent alongside the bagitPath field.
+_JSON_HEADERS = {"Content-Type": "application/json"}
+_EMPTY_FILE_PART = {"": ("", "")}
+
+# How long (in seconds) the list of superuser emails notified about files that
+# are not locally available is cached
+SUPERUSER_EMAILS_CACHE_SECONDS = 300
+
+# Interval bounds (in seconds) and relative jitter used by Arkivum._poll_status
+POLL_INITIAL_INTERVAL = 5
+POLL_MAX_INTERVAL = 60
+POLL_JITTER = 0.2
+
+
+def _log_response(response):
+    """Log the status of an Arkivum response, and its body at DEBUG level.
+
+    Reading ``response.text`` downloads and decodes the whole body, so it is
+    only touched when the DEBUG message would actually be emitted.
+    """
+    LOGGER.info("Response: %s", response.status_code)
+    if LOGGER.isEnabledFor(logging.DEBUG):
+        LOGGER.debug("Response text: %s", response.text)
+
+
+def _findtext(xpath, element):
+    """Return the first text node matched by xpath, or None like findtext."""
+    texts = xpath(element)
+    return texts[0] if texts else None
+
+
+def _first_file(path):
+    """Return the path of the first regular file found under path, or None.
+
+    Stops at the first match rather than walking the whole tree.
+    """
+    stack = [path]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False):
+                    return entry.path
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+    return None
+
+
+def _superuser_emails():
+    """Return the email addresses of active superusers."""
+    return cache.get_or_set(
+        "arkivum_superuser_emails",
+        lambda: list(
+            get_user_model()
+            .objects.filter(is_superuser=True, is_active=True)
+            .distinct()
+            .values_list("email", flat=True)
+        ),
+        SUPERUSER_EMAILS_CACHE_SECONDS,
+    )
+
+
+def _send_mail(**kwargs):
+    try:
+        django.core.mail.send_mail(**kwargs)
+    except Exception:
+        LOGGER.warning("Unable to send email", exc_info=True)
+
+
+def _send_mail_in_background(**kwargs):
+    """Send an email from a daemon thread so the caller doesn't wait on SMTP."""
+    thread = threading.Thread(target=_send_mail, kwargs=kwargs)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def _partition_files(files, parts):
+    """Split (path, size) pairs into at most `parts` lists of similar total size."""
+    chunks = [[] for _ in range(parts)]
+    totals = [0] * parts
+    for path, size in sorted(files, key=lambda f: f[1], reverse=True):
+        smallest = totals.index(min(totals))
+        chunks[smallest].append(path)
+        totals[smallest] += size
+    return [chunk for chunk in chunks if chunk]
+
+
+def _raise(error):
+    """os.walk onerror handler that re-raises the error."""
+    raise error
+
+
+def _run_rsync(command):
+    """Run an rsync command, returning an error message if it failed."""
+    LOGGER.info("rsync command: %s", command)
+    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    stdout = p.communicate()[0]
+    if p.returncode != 0:
+        s = "Rsync failed with status {}: {}".format(p.returncode, stdout)
+        LOGGER.warning(s)
+        return s
+    return None
+
+
+def _isoformat(timestamp):
+    """Return an Arkivum timestamp in ISO 8601 format.
+
+    Arkivum reports dates as YYYY-MM-DD, which are parsed directly; anything
+    else falls back to the much slower dateutil parser.
+    """
+    try:
+        return datetime.datetime.strptime(timestamp, "%Y-%m-%d").isoformat()
+    except ValueError:
+        return dateutil.parser.parse(timestamp).isoformat()
+
+
+def _url_path(*parts):
+    """Join path parts for an Arkivum URL without doubled or leading slashes."""
+    return posixpath.join(*(part.strip("/") for part in parts))
+
+
+def _retry_after(response):
+    """Return the delay in seconds requested by a 503 response, or None."""
+    if response.status_code != 503:
+        return None
+    try:
+        return max(0, int(response.headers.get("Retry-After", "")))
+    except ValueError:
+        return None
+
 
 class Arkivum(models.Model):
     space = models.OneToOneField("Space", to_field="uuid", on_delete=models.CASCADE)
@@ -68,6 +245,10 @@ class Arkivum(models.Model):
 
     ALLOWED_LOCATION_PURPOSE = [Location.AIP_STORAGE]
 
+    @property
+    def base_url(self):
+        return f"https://{self.host}"
+
     def browse(self, path):
         # Support browse so that the Location select works
         if self.remote_user and self.remote_name:
@@ -82,14 +263,15 @@ class Arkivum(models.Model):
     def delete_path(self, delete_path):
         # Can this be done by just deleting the file on disk?
         # TODO folders
-        url = "https://" + self.host + "/files/" + delete_path
+        url = f"{self.base_url}/files/{delete_path}"
         LOGGER.info("URL: %s", url)
-        response = requests.delete(url, verify=VERIFY)
-        LOGGER.info(
-            "Response: %s, Response text: %s", response.status_code, response.text
-        )
+        response = _SESSION.delete(url, timeout=_TIMEOUT)
         if response.status_code != 204:
+            LOGGER.info(
+                "Response: %s, Response text: %s", response.status_code, response.text
+            )
             raise StorageException("Unable to delete %s", delete_path)
+        LOGGER.info("Response: %s", response.status_code)
 
     def move_to_storage_service(self, src_path, dest_path, dest_space):
         """ Moves src_path to dest_space.staging_path/dest_path. """
@@ -100,7 +282,7 @@ class Arkivum(models.Model):
                 user=self.remote_user, host=self.remote_name, path=src_path
             )
         self.space.create_local_directory(dest_path)
-        self.space.move_rsync(src_path, dest_path)
+        self.move_rsync_parallel(src_path, dest_path)
 
     def move_from_storage_service(self, source_path, destination_path, package=None):
         """ Moves self.staging_path/src_path to dest_path. """
@@ -117,7 +299,98 @@ class Arkivum(models.Model):
             rsync_dest = destination_path
             self.space.create_local_directory(destination_path)
             try_mv_local = True
-        self.space.move_rsync(source_path, rsync_dest, try_mv_local=try_mv_local)
+        self.move_rsync_parallel(source_path, rsync_dest, try_mv_local=try_mv_local)
+
+    def move_rsync_parallel(
+        self, source, destination, try_mv_local=False, workers=None
+    ):
+        """
+        Moves source to destination like Space.move_rsync, splitting large
+        directories across several concurrent rsync processes.
+
+        A local source directory of at least ARKIVUM_PARALLEL_RSYNC_THRESHOLD
+        bytes has its files partitioned by size into one list per worker, and
+        each list is transferred by its own rsync with --files-from. Files,
+        remote sources, smaller directories and moves that may be done with a
+        local rename are left to Space.move_rsync.
+
+        :param source: Path to source file or directory. May have user@host: at beginning.
+        :param destination: Path to destination file or directory. May have user@host: at the beginning.
+        :param bool try_mv_local: Passed on to Space.move_rsync.
+        :param int workers: Number of rsync processes to run. Defaults to ARKIVUM_PARALLEL_RSYNC_WORKERS.
+        """
+        source = utils.coerce_str(source)
+        destination = utils.coerce_str(destination)
+        threshold = settings.ARKIVUM_PARALLEL_RSYNC_THRESHOLD
+        workers = workers or settings.ARKIVUM_PARALLEL_RSYNC_WORKERS
+        if try_mv_local or not threshold or workers < 2 or not os.path.isdir(source):
+            return self.space.move_rsync(source, destination, try_mv_local=try_mv_local)
+
+        # Like rsync, copy the directory itself unless source ends with a slash
+        if source.endswith("/"):
+            base, prefix = source, ""
+        else:
+            base = os.path.join(os.path.dirname(source), "")
+            prefix = os.path.basename(source)
+        dirs, files, total = [], [], 0
+        try:
+            for dirpath, __, filenames in os.walk(source, onerror=_raise):
+                reldir = os.path.normpath(
+                    os.path.join(prefix, os.path.relpath(dirpath, source))
+                )
+                if reldir != ".":
+                    dirs.append(reldir)
+                for filename in filenames:
+                    size = os.lstat(os.path.join(dirpath, filename)).st_size
+                    files.append(
+                        (os.path.normpath(os.path.join(reldir, filename)), size)
+                    )
+                    total += size
+        except OSError:
+            # Anything we can't list would be missing from every file list, so
+            # let a single rsync copy the tree and report the error itself
+            LOGGER.warning("Unable to list %s", source, exc_info=True)
+            return self.space.move_rsync(source, destination)
+        if total < threshold:
+            return self.space.move_rsync(source, destination)
+
+        LOGGER.info(
+            "Moving %s (%s bytes) to %s with %s rsync processes",
+            source,
+            total,
+            destination,
+            workers,
+        )
+        # Directories go with the first list so that empty ones are created
+        chunks = _partition_files(files, workers) or [[]]
+        chunks[0] = dirs + chunks[0]
+        list_dir = tempfile.mkdtemp()
+        try:
+            commands = []
+            for i, chunk in enumerate(chunks):
+                list_path = os.path.join(list_dir, str(i))
+                with open(list_path, "wb") as f:
+                    f.write(b"\0".join(os.fsencode(path) for path in chunk))
+                commands.append(
+                    [
+                        "rsync",
+                        "-t",
+                        "-O",
+                        "--protect-args",
+                        "-vv",
+                        "--chmod=Fug+rw,o-rwx,Dug+rwx,o-rwx",
+                        "--from0",
+                        "--files-from=" + list_path,
+                        base,
+                        destination,
+                    ]
+                )
+            with ThreadPoolExecutor(max_workers=len(commands)) as pool:
+                errors = [e for e in pool.map(_run_rsync, commands) if e]
+        finally:
+            shutil.rmtree(list_dir)
+        if errors:
+            raise StorageException("\n".join(errors))
 
     def post_move_from_storage_service(self, staging_path, destination_path, package):
         """ POST to Arkivum with information about the newly stored Package. """
@@ -126,20 +399,16 @@ class Arkivum(models.Model):
 
         relative_path = os.path.relpath(destination_path, self.space.path)
         if package.is_compressed:  # Single-file package
-            url = "https://" + self.host + "/api/2/files/release/" + relative_path
-            headers = {"Content-Type": "application/json"}
+            url = f"{self.base_url}/api/2/files/release/{relative_path}"
+            headers = _JSON_HEADERS
 
             # Get size, checksum, and checksum algorithm from pointer file;
             # infer compression algorithm from filename.
             root = etree.parse(package.full_pointer_file_path)
-            fixity_elem = root.find(".//premis:fixity", namespaces=utils.NSMAP)
-            algorithm = fixity_elem.findtext(
-                "premis:messageDigestAlgorithm", namespaces=utils.NSMAP
-            )
-            checksum = fixity_elem.findtext(
-                "premis:messageDigest", namespaces=utils.NSMAP
-            )
-            size = fixity_elem.findtext("premis:size", namespaces=utils.NSMAP)
+            fixity_elem = _FIXITY_XPATH(root)[0]
+            algorithm = _findtext(_ALGORITHM_XPATH, fixity_elem)
+            checksum = _findtext(_CHECKSUM_XPATH, fixity_elem)
+            size = _findtext(_SIZE_XPATH, fixity_elem)
             payload = {
                 "size": size,
                 "checksum": checksum,
@@ -149,11 +418,11 @@ class Arkivum(models.Model):
             payload = json.dumps(payload)
             files = None
         else:  # uncompressed bag
-            url = "https://" + self.host + "/api/3/ingest-manifest/release"
+            url = f"{self.base_url}/api/3/ingest-manifest/release"
             headers = None
             # FIXME Destination path has to exclude mount path, but what is part of the mounth path? Let's pretend it's the Space path
             payload = {"bagitPath": os.path.join("/", relative_path)}
-            files = {"": ("", "")}
+            files = _EMPTY_FILE_PART
 
         LOGGER.debug(
             "POST URL: %s; Header: %s; Payload: %s; Files: %s",
@@ -163,18 +432,22 @@ class Arkivum(models.Model):
             files,
         )
         try:
-            response = requests.post(
-                url, headers=headers, data=payload, files=files, verify=VERIFY
+            response = _SESSION.post(
+                url, headers=headers, data=payload, files=files, timeout=_TIMEOUT
             )
+        except requests.exceptions.Timeout:
+            LOGGER.exception("Timed out on POST to %s", url)
+            raise StorageException(_("Timed out on POST to %(url)s"), {"url": url})
         except requests.exceptions.ConnectionError:
             LOGGER.exception("Error in connection for POST to %s", url)
             raise StorageException(
                 _("Error in connection for POST to %(url)s"), {"url": url}
             )
 
-        LOGGER.debug(
-            "Response: %s, Response text: %s", response.status_code, response.text
-        )
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            LOGGER.debug(
+                "Response: %s, Response text: %s", response.status_code, response.text
+            )
         if response.status_code not in (requests.codes.ok, requests.codes.accepted):
             LOGGER.warning(
                 "Arkivum responded with %s: %s", response.status_code, response.text
@@ -194,12 +467,27 @@ class Arkivum(models.Model):
         # Store request ID in misc_attributes
         request_id = response_json["id"]
         package.misc_attributes.update({"arkivum_identifier": request_id})
-        package.save()
+        package._arkivum_info_cache = None
+        package.save(update_fields=["misc_attributes"])
 
-    def _get_package_info(self, package):
+    def _get_package_info(self, package, use_cache=False):
         """
         Return status and file info for a package in Arkivum.
+
+        Successful responses are remembered on the package instance, so a
+        caller that only needs a recent answer (e.g. is_file_local right after
+        a status update on the same package) can pass use_cache=True to avoid
+        asking Arkivum again. Package instances are request scoped, so the
+        cache never outlives the request that filled it.
+
+        :param bool use_cache: If True, return the info previously fetched for
+            this package and Arkivum request ID, if any.
         """
+        if use_cache:
+            cached = getattr(package, "_arkivum_info_cache", None)
+            identifier = package.misc_attributes.get("arkivum_identifier")
+            if cached is not None and identifier and cached[0] == identifier:
+                return cached[1]
         # If no request ID, try POSTing to Arkivum again
         if "arkivum_identifier" not in package.misc_attributes:
             # Get local copy
@@ -212,37 +500,34 @@ class Arkivum(models.Model):
             return {"error": True, "error_message": msg}
 
         # Ask Arkivum for replication status
+        identifier = package.misc_attributes["arkivum_identifier"]
         if package.is_compressed:
-            url = (
-                "https://"
-                + self.host
-                + "/api/2/files/release/"
-                + package.misc_attributes["arkivum_identifier"]
-            )
+            url = f"{self.base_url}/api/2/files/release/{identifier}"
         else:
-            url = (
-                "https://"
-                + self.host
-                + "/api/3/ingest-manifest/status/"
-                + package.misc_attributes["arkivum_identifier"]
-            )
+            url = f"{self.base_url}/api/3/ingest-manifest/status/{identifier}"
 
         LOGGER.info("URL: %s", url)
         try:
-            response = requests.get(url, verify=VERIFY)
+            response = _SESSION.get(url, timeout=_TIMEOUT)
+        except requests.exceptions.Timeout:
+            msg = _("Timed out fetching package status")
+            LOGGER.warning(msg, exc_info=True)
+            return {"error": True, "error_message": msg}
         except Exception:
             msg = _("Error fetching package status")
             LOGGER.warning(msg, exc_info=True)
             return {"error": True, "error_message": msg}
-        LOGGER.info(
-            "Response: %s, Response text: %s", response.status_code, response.text
-        )
+        _log_response(response)
         if response.status_code != 200:
             msg = _("Response from Arkivum server was %(response)s") % {
                 "response": response
             }
-            LOGGER.warning(msg)
-            return {"error": True, "error_message": msg}
+            LOGGER.warning("%s: %s", msg, response.text)
+            return {
+                "error": True,
+                "error_message": msg,
+                "retry_after": _retry_after(response),
+            }
 
         try:
             response_json = response.json()
@@ -250,6 +535,11 @@ class Arkivum(models.Model):
             msg = _("JSON could not be parsed from package info")
             LOGGER.warning(msg)
             return {"error": True, "error_message": msg}
+        except requests.exceptions.RequestException:
+            msg = _("Error fetching package status")
+            LOGGER.warning(msg, exc_info=True)
+            return {"error": True, "error_message": msg}
+        package._arkivum_info_cache = (identifier, response_json)
         return response_json
 
     def _get_baginfo_txt_info(self, package):
@@ -258,33 +548,34 @@ class Arkivum(models.Model):
         To be used as a fallback to obtain replication status of an
         uncompressed package when it is not returned by the
         ingest-manifest/status call in _get_package_info()
+
+        Reads package.current_location, so fetch packages with
+        select_related("current_location") when checking many of them.
         """
-        location = package.current_location
-        url = (
-            "https://"
-            + self.host
-            + "/api/2/files/fileInfo/"
-            + location.relative_path.strip("/")
-            + "/"
-            + package.current_path.strip("/")
-            + "/bag-info.txt"
+        url_path = _url_path(
+            package.current_location.relative_path,
+            package.current_path,
+            "bag-info.txt",
         )
+        url = f"{self.base_url}/api/2/files/fileInfo/{url_path}"
         LOGGER.info("URL: %s", url)
 
         try:
-            response = requests.get(url, verify=VERIFY)
+            response = _SESSION.get(url, timeout=_TIMEOUT)
+        except requests.exceptions.Timeout:
+            msg = _("Timed out fetching file info")
+            LOGGER.warning(msg, exc_info=True)
+            return {"error": True, "error_message": msg}
         except Exception:
             msg = _("Error fetching file info")
             LOGGER.warning(msg, exc_info=True)
             return {"error": True, "error_message": msg}
-        LOGGER.info(
-            "Response: %s, Response text: %s", response.status_code, response.text
-        )
+        _log_response(response)
         if response.status_code != 200:
             msg = _("Response from Arkivum server was %(response)s") % {
                 "response": response
             }
-            LOGGER.warning(msg)
+            LOGGER.warning("%s: %s", msg, response.text)
             return {"error": True, "error_message": msg}
 
         try:
@@ -293,13 +584,23 @@ class Arkivum(models.Model):
             msg = _("JSON could not be parsed from file info")
             LOGGER.warning(msg)
             return {"error": True, "error_message": msg}
+        except requests.exceptions.RequestException:
+            msg = _("Error fetching file info")
+            LOGGER.warning(msg, exc_info=True)
+            return {"error": True, "error_message": msg}
         return response_json
 
-    def update_package_status(self, package):
-        LOGGER.info("Package status: %s", package.status)
+    def _get_replication_state(self, package):
+        """
+        Return the replication state of a package in Arkivum.
+
+        :return: Tuple of (replication state, error). error is None on success,
+            otherwise the error dict returned by the failed request and the
+            replication state is None.
+        """
         response_json = self._get_package_info(package)
         if response_json.get("error"):
-            return (None, response_json["error_message"])
+            return (None, response_json)
         if package.is_compressed:
             # Look for ['fileInformation']['replicationState'] == 'green'
             replication = response_json.get("fileInformation", {}).get(
@@ -313,19 +614,116 @@ class Arkivum(models.Model):
             if replication is None:
                 response_json = self._get_baginfo_txt_info(package)
                 if response_json.get("error"):
-                    return (None, response_json["error_message"])
+                    return (None, response_json)
                 replication = response_json.get("replicationState", "")
+        return (replication, None)
+
+    def _poll_status(self, package, max_wait=0, budget=None):
+        """
+        Poll Arkivum for the replication state of a package until it is green.
+
+        Polls start POLL_INITIAL_INTERVAL seconds apart and the interval doubles
+        (up to POLL_MAX_INTERVAL, with +/- POLL_JITTER jitter) while the state
+        is unchanged or requests fail. A change of state resets the interval,
+        and a Retry-After header on a 503 response overrides it.
+
+        :param package: Package to check the replication state of.
+        :param int max_wait: Seconds to keep polling for. With 0 only one
+            request is made.
+        :param int budget: Optional maximum number of status requests.
+        :return: Tuple of (replication state, error) from the last poll, as
+            returned by _get_replication_state.
+        """
+        deadline = time.monotonic() + max_wait
+        interval = POLL_INITIAL_INTERVAL
+        previous = None
+        attempts = 0
+        while True:
+            replication, error = self._get_replication_state(package)
+            attempts += 1
+            if replication is not None and replication.lower() == "green":
+                break
+            if budget is not None and attempts >= budget:
+                break
+            if error and error.get("retry_after") is not None:
+                delay = error["retry_after"]
+            else:
+                if replication != previous:
+                    interval = POLL_INITIAL_INTERVAL
+                delay = interval * random.uniform(1 - POLL_JITTER, 1 + POLL_JITTER)
+                interval = min(interval * 2, POLL_MAX_INTERVAL)
+            previous = replication
+            if delay > deadline - time.monotonic():
+                break
+            LOGGER.debug(
+                "Replication state %s, polling again in %ss", replication, delay
+            )
+            time.sleep(delay)
+        return (replication, error)
+
+    def update_package_status(self, package):
+        LOGGER.info("Package status: %s", package.status)
+        replication, error = self._poll_status(
+            package, max_wait=settings.ARKIVUM_POLL_MAX_WAIT
+        )
+        if error:
+            return (None, error["error_message"])
         if replication.lower() == "green":
             # Set status to UPLOADED
             package.status = Package.UPLOADED
-            package.save()
+            package.save(update_fields=["status"])
         LOGGER.info("Package status: %s", package.status)
         return (package.status, _("Replication status: ") + replication)
 
+    def _get_replication_state_in_thread(self, package):
+        """Run _get_replication_state from a worker thread."""
+        try:
+            return self._get_replication_state(package)
+        finally:
+            # Django opens one DB connection per thread, release ours
+            connection.close()
+
+    def batch_update_package_status(self, packages):
+        """
+        Update the status of several packages stored in this space at once.
+
+        The replication state of each package is requested concurrently, with
+        up to ARKIVUM_POLL_WORKERS requests in flight, and every package that
+        has replicated is marked as uploaded. Packages are saved one by one
+        with update_fields, like update_package_status, so post_save receivers
+        still run. Callers should fetch packages with
+        select_related("current_location__space") so that worker threads do
+        not have to query the database.
+
+        Nothing in the Storage Service calls this yet; it is meant for callers
+        that check many Arkivum packages at once.
+
+        :param packages: Iterable of Package objects.
+        :return: List of (status, message) tuples in the order of packages, as
+            returned by update_package_status.
+        """
+        packages = list(packages)
+        with ThreadPoolExecutor(max_workers=settings.ARKIVUM_POLL_WORKERS) as pool:
+            states = list(pool.map(self._get_replication_state_in_thread, packages))
+
+        results = []
+        for package, (replication, error) in zip(packages, states):
+            if error:
+                results.append((None, error["error_message"]))
+                continue
+            if replication.lower() == "green":
+                package.status = Package.UPLOADED
+                package.save(update_fields=["status"])
+            results.append((package.status, _("Replication status: ") + replication))
+        return results
+
     def is_file_local(self, package, path=None, email_nonlocal=False):
         """
         Check if (a file in) this package is locally available.
 
+        Reads package.current_location, so fetch packages with
+        select_related("current_location") when checking many of them.
+
         :param package: Package object that contains the file
         :param str path: Relative path to the file inside the package to check. If None, checks the whole package.n
         :param bool email_nonlocal: True if it should email superusers when the file is not cached by Arkivum.
@@ -338,45 +736,47 @@ class Arkivum(models.Model):
             email_nonlocal,
         )
         if package.is_compressed:
-            package_info = self._get_package_info(package)
+            package_info = self._get_package_info(package, use_cache=True)
             if package_info.get("error"):
                 return None
             # Look for ['fileInformation']['local'] == True
             package_info = package_info["fileInformation"]
         else:  # uncompressed
             if path:
-                url_path = (
-                    package.current_location.relative_path
-                    + "/"
-                    + package.current_path
-                    + "/"
-                    + path
+                url_path = _url_path(
+                    package.current_location.relative_path, package.current_path, path
                 )
-                url_path = six.moves.urllib.parse.quote_plus(url_path, safe="/")
-                url = "https://" + self.host + "/api/2/files/fileInfo/" + url_path
+                url_path = quote_plus(url_path, safe="/")
+                url = f"{self.base_url}/api/2/files/fileInfo/{url_path}"
                 LOGGER.info("URL: %s", url)
                 try:
-                    response = requests.get(url, verify=VERIFY)
+                    response = _SESSION.get(url, timeout=_TIMEOUT)
+                except requests.exceptions.Timeout:
+                    LOGGER.warning("Timed out fetching file information", exc_info=True)
+                    return None
                 except Exception:
                     LOGGER.warning("Error fetching file information", exc_info=True)
                     return None
-                LOGGER.info(
-                    "Response: %s, Response text: %s",
-                    response.status_code,
-                    response.text,
-                )
+                _log_response(response)
                 if response.status_code != 200:
-                    LOGGER.warning("Response from Arkivum server was %s", response)
+                    LOGGER.warning(
+                        "Response from Arkivum server was %s: %s",
+                        response,
+                        response.text,
+                    )
                     return None
                 try:
                     package_info = response.json()
                 except ValueError:
                     LOGGER.warning("JSON could not be parsed from package info")
                     return None
+                except requests.exceptions.RequestException:
+                    LOGGER.warning("Error fetching file information", exc_info=True)
+                    return None
             else:
                 # TODO Implement checking all files in an uncompressed package
                 # TODO This may be available from _get_package_info in future
-                package_info = self._get_package_info(package)
+                package_info = self._get_package_info(package, use_cache=True)
                 if package_info.get("error"):
                     return None
                 if "local" not in package_info:
@@ -385,10 +785,10 @@ class Arkivum(models.Model):
                     )
                     # Pick a random file and check the locality of it.
                     # WARNING assumes the package is local/not local as a unit.
-                    for dirpath, dirs, files in scandir.walk(package.full_path):
-                        if files:
-                            file_path = os.path.join(dirpath, files[0])
-                            break
+                    file_path = _first_file(package.full_path)
+                    if file_path is None:
+                        LOGGER.warning("No files found in %s", package.full_path)
+                        return None
                     file_path = os.path.relpath(file_path, package.full_path)
                     return self.is_file_local(package, file_path, email_nonlocal)
         LOGGER.debug("File info local: %s", package_info.get("local"))
@@ -407,13 +807,11 @@ class Arkivum(models.Model):
                     "%(item)s with Arkivum ID of %(package_id)s has been requested but is not available in the Arkivum cache."
                 ) % {"item": item, "package_id": package_info.get("id")}
 
-                django.core.mail.send_mail(
+                # Translations are per thread, so the subject is rendered here
+                _send_mail_in_background(
                     from_email=settings.DEFAULT_FROM_EMAIL,
-                    recipient_list=get_user_model()
-                    .objects.filter(is_superuser=True, is_active=True)
-                    .distinct()
-                    .values_list("email", flat=True),
-                    subject=_("Arkivum file not locally available"),
+                    recipient_list=_superuser_emails(),
+                    subject=str(_("Arkivum file not locally available")),
                     message=message,
                 )
             return False
@@ -434,7 +832,7 @@ class Arkivum(models.Model):
             raise NotImplementedError(
                 "Arkivum does not implement fixity for compressed packages"
             )
-        package_info = self._get_package_info(package)
+        package_info = self._get_package_info(package, use_cache=True)
         if package_info.get("error"):
             return (False, [], package_info["error_message"], None)
 
@@ -456,6 +854,6 @@ class Arkivum(models.Model):
             message = errors[0]["reason"]
         timestamp = package_info.get("fixityLastChecked")
         if timestamp:
-            timestamp = dateutil.parser.parse(timestamp).isoformat()
+            timestamp = _isoformat(timestamp)
 
         return (success, errors, message, timestamp)
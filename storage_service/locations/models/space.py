@@ -235,6 +235,8 @@ class Space(models.Model):
 
         protocol_model = PROTOCOL[self.access_protocol]["model"]
         protocol_space = protocol_model.objects.get(space=self)
+        # Reuse this instance so protocol_space.space doesn't query it again
+        protocol_space.space = self
         # TODO try-catch AttributeError if remote_user or remote_name not exist?
         return protocol_space
 
@@ -2,11 +2,17 @@ from __future__ import absolute_import
 import os
 import requests
 import shutil
+import unittest
+from unittest import mock
 import vcr
 
-from django.test import TestCase
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db.models.signals import post_save
+from django.test import TestCase, override_settings
 
 from locations import models
+from locations.models import arkivum
 from . import TempDirMixin
 from six.moves import range
 
@@ -204,3 +210,304 @@ class TestArkivum(TempDirMixin, TestCase):
         self.arkivum_object.update_package_status(self.uncompressed_package)
         # Verify UPLOADED
         assert self.uncompressed_package.status == models.Package.UPLOADED
+
+    @mock.patch("locations.models.arkivum.random.uniform", return_value=1)
+    @mock.patch("locations.models.arkivum.time.sleep")
+    def test_poll_status_backs_off_until_green(self, sleep, uniform):
+        states = [("amber", None), ("amber", None), ("yellow", None), ("green", None)]
+        with mock.patch.object(
+            models.Arkivum, "_get_replication_state", side_effect=states
+        ):
+            replication, error = self.arkivum_object._poll_status(
+                self.package, max_wait=3600
+            )
+        assert replication == "green"
+        assert error is None
+        # Interval doubles while unchanged and resets on a state change
+        assert [c[0][0] for c in sleep.call_args_list] == [5, 10, 5]
+
+    @mock.patch("locations.models.arkivum.time.sleep")
+    def test_poll_status_honours_retry_after_and_budget(self, sleep):
+        error = {"error": True, "error_message": "Busy", "retry_after": 42}
+        with mock.patch.object(
+            models.Arkivum, "_get_replication_state", return_value=(None, error)
+        ) as get_state:
+            replication, err = self.arkivum_object._poll_status(
+                self.package, max_wait=3600, budget=3
+            )
+        assert replication is None
+        assert err == error
+        assert get_state.call_count == 3
+        assert [c[0][0] for c in sleep.call_args_list] == [42, 42]
+
+    @mock.patch("locations.models.arkivum.time.sleep")
+    def test_poll_status_waits_for_retry_after_from_arkivum(self, sleep):
+        self.package.misc_attributes.update(
+            {"arkivum_identifier": "2e75c8ad-cded-4f7e-8ac7-85627a116e39"}
+        )
+        response = mock.Mock(status_code=503, headers={"Retry-After": "7"}, text="")
+        with mock.patch(
+            "locations.models.arkivum._SESSION.get", return_value=response
+        ) as get:
+            replication, error = self.arkivum_object._poll_status(
+                self.package, max_wait=3600, budget=2
+            )
+        assert replication is None
+        assert error["retry_after"] == 7
+        assert get.call_count == 2
+        sleep.assert_called_once_with(7)
+
+    @mock.patch("locations.models.arkivum.time.sleep")
+    def test_poll_status_single_request_without_max_wait(self, sleep):
+        with mock.patch.object(
+            models.Arkivum, "_get_replication_state", return_value=("amber", None)
+        ) as get_state:
+            self.arkivum_object._poll_status(self.package)
+        get_state.assert_called_once_with(self.package)
+        sleep.assert_not_called()
+
+    def test_get_package_info_reuses_cached_info(self):
+        self.package.misc_attributes.update(
+            {"arkivum_identifier": "2e75c8ad-cded-4f7e-8ac7-85627a116e39"}
+        )
+        info = {"fileInformation": {"local": True}}
+        response = mock.Mock(status_code=200, **{"json.return_value": info})
+        with mock.patch(
+            "locations.models.arkivum._SESSION.get", return_value=response
+        ) as get:
+            assert self.arkivum_object._get_package_info(self.package) == info
+            assert (
+                self.arkivum_object._get_package_info(self.package, use_cache=True)
+                == info
+            )
+            # Without use_cache Arkivum is always asked again
+            self.arkivum_object._get_package_info(self.package)
+        assert get.call_count == 2
+
+    def test_body_read_errors_are_reported(self):
+        self.package.misc_attributes.update(
+            {"arkivum_identifier": "2e75c8ad-cded-4f7e-8ac7-85627a116e39"}
+        )
+        response = mock.Mock(
+            status_code=200,
+            **{"json.side_effect": requests.exceptions.ConnectionError},
+        )
+        with mock.patch(
+            "locations.models.arkivum._SESSION.get", return_value=response
+        ) as get:
+            info = self.arkivum_object._get_package_info(self.package)
+            baginfo = self.arkivum_object._get_baginfo_txt_info(
+                self.uncompressed_package
+            )
+            is_local = self.arkivum_object.is_file_local(
+                self.uncompressed_package, path="data/file.txt"
+            )
+        assert info == {"error": True, "error_message": "Error fetching package status"}
+        assert baginfo == {"error": True, "error_message": "Error fetching file info"}
+        assert is_local is None
+        # Bodies are read by get(), inside its error handling
+        assert all("stream" not in c[1] for c in get.call_args_list)
+
+    def test_batch_update_package_status(self):
+        states = {
+            self.package.pk: ("green", None),
+            self.uncompressed_package.pk: ("amber", None),
+        }
+        saved = mock.Mock()
+        with mock.patch.object(
+            models.Arkivum,
+            "_get_replication_state",
+            side_effect=lambda package: states[package.pk],
+        ):
+            post_save.connect(saved, sender=models.Package)
+            try:
+                results = self.arkivum_object.batch_update_package_status(
+                    [self.package, self.uncompressed_package]
+                )
+            finally:
+                post_save.disconnect(saved, sender=models.Package)
+        assert results == [
+            (models.Package.UPLOADED, "Replication status: green"),
+            (models.Package.STAGING, "Replication status: amber"),
+        ]
+        self.package.refresh_from_db()
+        self.uncompressed_package.refresh_from_db()
+        assert self.package.status == models.Package.UPLOADED
+        assert self.uncompressed_package.status == models.Package.STAGING
+        # Only the replicated package is saved, and post_save still runs
+        saved.assert_called_once()
+        assert saved.call_args[1]["instance"] == self.package
+        assert saved.call_args[1]["update_fields"] == frozenset(["status"])
+
+    def test_get_child_space_reuses_space(self):
+        space = models.Space.objects.get(uuid=self.arkivum_object.space.uuid)
+        with self.assertNumQueries(1):
+            child = space.get_child_space()
+            assert child.space is space
+            assert child.space.access_protocol == models.Space.ARKIVUM
+
+    def test_update_package_status_queries(self):
+        package = models.Package.objects.select_related(
+            "current_location__space"
+        ).get(uuid=self.package.uuid)
+        with mock.patch.object(
+            models.Arkivum, "_get_replication_state", return_value=("amber", None)
+        ), self.assertNumQueries(1):
+            status, _ = package.current_location.space.update_package_status(package)
+        assert status == models.Package.STAGING
+
+    def test_first_file(self):
+        root = self.tmpdir / "first_file"
+        (root / "empty").mkdir(parents=True)
+        assert arkivum._first_file(str(root)) is None
+        (root / "data" / "objects").mkdir(parents=True)
+        (root / "data" / "objects" / "file.txt").write_text("contents")
+        assert arkivum._first_file(str(root)) == str(
+            root / "data" / "objects" / "file.txt"
+        )
+
+    @mock.patch("locations.models.arkivum._send_mail_in_background")
+    def test_is_file_local_emails_superusers_in_background(self, send_mail):
+        cache.clear()
+        get_user_model().objects.create_superuser(
+            "arkivum-admin", "admin@example.com", "password"
+        )
+        info = {"fileInformation": {"local": False, "id": "arkivum-id"}}
+        with mock.patch.object(models.Arkivum, "_get_package_info", return_value=info):
+            is_local = self.arkivum_object.is_file_local(
+                self.package, email_nonlocal=True
+            )
+        assert is_local is False
+        send_mail.assert_called_once()
+        assert "admin@example.com" in send_mail.call_args[1]["recipient_list"]
+        assert "arkivum-id" in send_mail.call_args[1]["message"]
+
+    @override_settings(
+        ARKIVUM_PARALLEL_RSYNC_THRESHOLD=1, ARKIVUM_PARALLEL_RSYNC_WORKERS=2
+    )
+    def test_move_rsync_parallel_splits_directory(self):
+        source = self.tmpdir / "bag"
+        (source / "data").mkdir(parents=True)
+        (source / "bagit.txt").write_text("a" * 10)
+        (source / "data" / "big.bin").write_text("b" * 100)
+        file_lists = []
+
+        def popen(command, **kwargs):
+            list_path = command[-3].split("=", 1)[1]
+            with open(list_path, "rb") as f:
+                file_lists.append(set(f.read().decode().split("\0")))
+            return mock.Mock(
+                **{"communicate.return_value": (b"", None), "returncode": 0}
+            )
+
+        with mock.patch("subprocess.Popen", side_effect=popen) as p:
+            self.arkivum_object.move_rsync_parallel(str(source), "user@host:/aips/")
+        assert p.call_count == 2
+        assert p.call_args[0][0][-2:] == [str(self.tmpdir) + "/", "user@host:/aips/"]
+        assert {"bag", "bag/data", "bag/data/big.bin"} in file_lists
+        assert {"bag/bagit.txt"} in file_lists
+
+    @override_settings(
+        ARKIVUM_PARALLEL_RSYNC_THRESHOLD=1024, ARKIVUM_PARALLEL_RSYNC_WORKERS=2
+    )
+    def test_move_rsync_parallel_falls_back_for_small_directories(self):
+        source = self.tmpdir / "small"
+        source.mkdir()
+        (source / "file.txt").write_text("contents")
+        with mock.patch.object(models.Space, "move_rsync") as move_rsync:
+            self.arkivum_object.move_rsync_parallel(str(source), "user@host:/aips/")
+        move_rsync.assert_called_once_with(str(source), "user@host:/aips/")
+
+    @override_settings(
+        ARKIVUM_PARALLEL_RSYNC_THRESHOLD=1, ARKIVUM_PARALLEL_RSYNC_WORKERS=2
+    )
+    def test_move_rsync_parallel_falls_back_when_listing_fails(self):
+        source = self.tmpdir / "bag"
+        (source / "data").mkdir(parents=True)
+        (source / "bagit.txt").write_text("a" * 10)
+
+        def walk(top, onerror=None):
+            # An unreadable subdirectory is reported through onerror
+            yield top, ["data"], ["bagit.txt"]
+            onerror(PermissionError(13, "Permission denied", top + "/data"))
+
+        with mock.patch.object(models.Space, "move_rsync") as move_rsync:
+            with mock.patch("os.walk", side_effect=walk), mock.patch(
+                "subprocess.Popen"
+            ) as popen:
+                self.arkivum_object.move_rsync_parallel(str(source), "user@host:/aips/")
+        move_rsync.assert_called_once_with(str(source), "user@host:/aips/")
+        popen.assert_not_called()
+
+    @unittest.skipUnless(shutil.which("rsync"), "rsync is not installed")
+    @override_settings(
+        ARKIVUM_PARALLEL_RSYNC_THRESHOLD=1, ARKIVUM_PARALLEL_RSYNC_WORKERS=3
+    )
+    def test_move_rsync_parallel_matches_move_rsync(self):
+        source = self.tmpdir / "bag"
+        (source / "data" / "objects" / "sub").mkdir(parents=True)
+        (source / "data" / "empty").mkdir()
+        (source / "bagit.txt").write_text("BagIt-Version: 0.97\n")
+        (source / "data" / "objects" / "big.bin").write_text("b" * 1000)
+        (source / "data" / "objects" / "sub" / "file 1.txt").write_text("c" * 10)
+        (source / "tagmanifest-md5.txt").write_text("d" * 100)
+        parallel = self.tmpdir / "parallel"
+        single = self.tmpdir / "single"
+        parallel.mkdir()
+        single.mkdir()
+
+        self.arkivum_object.move_rsync_parallel(str(source), str(parallel) + "/")
+        self.arkivum_object.space.move_rsync(str(source), str(single) + "/")
+
+        def tree(root):
+            entries = {}
+            for dirpath, dirnames, filenames in os.walk(str(root)):
+                for dirname in dirnames:
+                    entries[
+                        os.path.relpath(os.path.join(dirpath, dirname), root)
+                    ] = None
+                for filename in filenames:
+                    path = os.path.join(dirpath, filename)
+                    with open(path) as f:
+                        entries[os.path.relpath(path, root)] = f.read()
+            return entries
+
+        assert tree(parallel) == tree(single)
+        assert "bag/data/empty" in tree(parallel)
+
+    def test_isoformat(self):
+        assert arkivum._isoformat("2015-11-24") == "2015-11-24T00:00:00"
+        assert arkivum._isoformat("2015-11-24T10:20:30Z") == "2015-11-24T10:20:30+00:00"
+
+    def test_url_path(self):
+        assert arkivum._url_path("", "/aips/bag/", "bag-info.txt") == (
+            "aips/bag/bag-info.txt"
+        )
+        assert arkivum._url_path("arkivum/", "bag", "data/file.txt") == (
+            "arkivum/bag/data/file.txt"
+        )
+
+    def test_session_does_not_sleep_on_retry_after(self):
+        retries = arkivum._SESSION.get_adapter("https://arkivum.example").max_retries
+        assert 503 in retries.status_forcelist
+        assert retries.respect_retry_after_header is False
+
+    def test_session_does_not_retry_read_timeouts(self):
+        retries = arkivum._SESSION.get_adapter("https://arkivum.example").max_retries
+        assert retries.read is False
+
+    def test_get_package_info_reports_timeout(self):
+        self.package.misc_attributes.update(
+            {"arkivum_identifier": "2e75c8ad-cded-4f7e-8ac7-85627a116e39"}
+        )
+        with mock.patch(
+            "locations.models.arkivum._SESSION.get",
+            side_effect=requests.exceptions.ReadTimeout,
+        ) as get:
+            info = self.arkivum_object._get_package_info(self.package)
+        get.assert_called_once()
+        assert get.call_args[1]["timeout"] == arkivum._TIMEOUT
+        assert info == {
+            "error": True,
+            "error_message": "Timed out fetching package status",
+        }
@@ -388,7 +388,7 @@ def _handle_package_request_remote_result_notification(config, event, success):
 
 @permission_required("locations.change_package", raise_exception=True)
 def package_update_status(request, uuid):
-    package = Package.objects.get(uuid=uuid)
+    package = Package.objects.select_related("current_location__space").get(uuid=uuid)
 
     old_status = package.status
     try:
@@ -17,6 +17,9 @@ import six
 # S3 adapter configuration.
 from .components.s3 import *
 
+# Arkivum adapter configuration.
+from .components.arkivum import *
+
 from storage_service.settings.helpers import get_env_variable, is_true
 
 try:
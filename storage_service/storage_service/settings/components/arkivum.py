@@ -0,0 +1,37 @@
+"""Configure Arkivum
+
+From here we can configure aspects of Arkivum spaces in the Storage Service.
+"""
+from os import environ
+
+from django.core.exceptions import ImproperlyConfigured
+
+
+def _get_int(name, default):
+    try:
+        return int(environ.get(name, default))
+    except ValueError:
+        err_msg = "Arkivum setting configured incorrectly in the environment - please check the '{}' variable".format(
+            name
+        )
+        raise ImproperlyConfigured(err_msg)
+
+
+# Maximum number of seconds a package status update may keep polling Arkivum
+# (with exponential backoff) for replication to complete. The default of 0
+# issues a single status request per update.
+ARKIVUM_POLL_MAX_WAIT = _get_int("SS_ARKIVUM_POLL_MAX_WAIT", 0)
+
+# Number of concurrent status requests made by
+# Arkivum.batch_update_package_status.
+ARKIVUM_POLL_WORKERS = _get_int("SS_ARKIVUM_POLL_WORKERS", 8)
+
+# Connect and read timeouts, in seconds, for requests made to Arkivum.
+ARKIVUM_CONNECT_TIMEOUT = _get_int("SS_ARKIVUM_CONNECT_TIMEOUT", 5)
+ARKIVUM_READ_TIMEOUT = _get_int("SS_ARKIVUM_READ_TIMEOUT", 30)
+
+# Directories of at least this many bytes are moved to and from Arkivum with
+# several concurrent rsync processes. The default of 0 disables parallel
+# transfers.
+ARKIVUM_PARALLEL_RSYNC_THRESHOLD = _get_int("SS_ARKIVUM_PARALLEL_RSYNC_THRESHOLD", 0)
+ARKIVUM_PARALLEL_RSYNC_WORKERS = _get_int("SS_ARKIVUM_PARALLEL_RSYNC_WORKERS", 4)